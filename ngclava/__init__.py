@@ -1,5 +1,6 @@
 from ngclearn import numpy as _numpy
 from ngcsimlib.logger import warn
+from functools import lru_cache as _lru_cache
 
 _can_use_lava = True
 #Verify that the base version of numpy is being used
@@ -9,6 +10,7 @@ if _numpy.__name__ != "numpy":
                        f"\"packages\" section of the file")
     _can_use_lava = False
 
+@_lru_cache(maxsize=1)
 def lava_compatible_env():
     return _can_use_lava
 
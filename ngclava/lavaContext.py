@@ -4,17 +4,28 @@ builds a mirrored model using lava compatible processes and models.
 """
 
 from ngclearn import Context
-from ngclava.mapping.component_mapper import map_component
+from ngclava.mapping.component_mapper import map_component, _value_schema, _fits_precision, _SCALAR_TYPES
 from ngcsimlib.logger import info, warn, critical
 from ngclearn import Compartment
-from ngclava import lava_compatible_env
+from ngclava import _can_use_lava
 
 import json
+import sys
+from functools import lru_cache
+from operator import attrgetter
 
-# Lava
-from lava.magma.core.process.variable import Var
-from lava.magma.core.run_conditions import RunSteps
-from lava.magma.core.run_configs import Loihi2SimCfg
+_LAVA_ENV_OK = _can_use_lava
+_MISSING_LAVA_COMPONENT = "Could not fine a lava component with the name \"{}\" in the context"
+
+
+@lru_cache(maxsize=None)
+def _split_endpoint(name):
+    """
+    Splits the name of a connection endpoint ("component/compartment") into its
+    component and compartment names, cached by name.
+    """
+    component_name, compartment_name = name.split("/")
+    return component_name, compartment_name
 
 
 class LavaContext(Context):
@@ -54,16 +65,37 @@ class LavaContext(Context):
     lava components will no longer work post rebuild as all previous lava components
     are no longer used (They will still technically exist so no errors will be thrown).
 
+    If the context is created with `jit=True` the dynamics of every mapped lava
+    component are compiled with numba (if it is installed) when they are mapped.
+    If numba can not be imported the components fall back to plain python.
+
+    Args:
+        name: The name of the context
+
+        jit: a boolean for if the mapped lava components should be compiled with
+            numba (default: False)
+
+        precision: the precision to store the array parameters of mapped lava
+            components in, one of None (unchanged), "fp32", or "fp16". Parameters
+            that would overflow or underflow at this precision and scalar parameters
+            are left unchanged (default: None)
+
     """
+    __slots__ = ('_rebuild_lava', '_init_lava', '_jit', '_precision', '_in_runtime', '_exited_runtime',
+                 '_should_exit_runtime', 'dynamic_lava_processes', 'dynamic_lava_models', 'mapped_processes',
+                 'lagging_components', '_var_sync_plan', '_param_sync_plan', '_wiring_cache', '_topology_hash',
+                 '_inp_names', '_out_names')
 
-    def __init__(self, name):
+    def __init__(self, name, jit=False, precision=None):
         super().__init__(name)
-        self._rebuild_lava = lava_compatible_env()
+        self._rebuild_lava = _LAVA_ENV_OK
 
         if hasattr(self, "_init_lava"):
             return
 
         self._init_lava = True
+        self._jit = jit
+        self._precision = precision
         self._in_runtime = False
         self._exited_runtime = False
 
@@ -71,6 +103,12 @@ class LavaContext(Context):
         self.dynamic_lava_models = {}
         self.mapped_processes = {}
         self.lagging_components = {}
+        self._wiring_cache = {}
+        self._inp_names = {}
+        self._out_names = {}
+        self._var_sync_plan = {}
+        self._param_sync_plan = {}
+        self._topology_hash = None
 
         self._should_exit_runtime = False
 
@@ -81,7 +119,7 @@ class LavaContext(Context):
         a rebuild of the lava components upon exiting the with block.
         Will not rebuild if the current import environment is not compatible with lava
         """
-        self._rebuild_lava = lava_compatible_env()
+        self._rebuild_lava = _LAVA_ENV_OK
         return self
 
     @property
@@ -108,20 +146,40 @@ class LavaContext(Context):
             self.stop()
 
 
-    def rebuild_lava(self, toggle_off=True):
+    def rebuild_lava(self, toggle_off=True, force=False):
         """
-        Triggers a manual rebuild of the lava components
+        Triggers a manual rebuild of the lava components. If the topology of the
+        model (components, connections, lagging, value shapes, and scalar
+        parameters) has not changed since the last rebuild the existing lava
+        components are kept and only their compartment values and array
+        parameters are updated (see refresh_params()).
+
+        Args:
+            toggle_off: turn off the automatic rebuild flag once rebuilt (default: True)
+
+            force: always do a full rebuild, even if the topology, shapes, and
+                scalar parameters of the model are unchanged (default: False)
         """
         if self._in_runtime:
             warn("Stop your current runtime before rebuilding lava objects")
             return
-        if not lava_compatible_env():
+        if not _LAVA_ENV_OK:
             warn("The current environment is not compatible to build lava objects")
             return
-        info("Rebuilding lava components")
-        self._update_dynamic_class()
-        self._build_lava_processes()
-        self._wire_lava_processes()
+
+        topology_hash = self._compute_topology_hash()
+        if not force and not self._exited_runtime and len(self.mapped_processes) > 0 \
+                and topology_hash == self._topology_hash:
+            info("Refreshing lava component parameters")
+            self.refresh_params()
+        else:
+            info("Rebuilding lava components")
+            if topology_hash != self._topology_hash:
+                self._wiring_cache.clear()
+            self._update_dynamic_class()
+            self._build_lava_processes()
+            self._wire_lava_processes()
+            self._topology_hash = self._compute_topology_hash()
 
         self._exited_runtime = False
         if toggle_off:
@@ -153,12 +211,24 @@ class LavaContext(Context):
             status: a boolean for if the component should or should not be
                 lagged (default: True)
         """
-        if isinstance(component, str):
-            self.lagging_components[component] = status
-            self._json_objects['components'][self.components[component].path]['lagging'] = status
-        else:
-            self.lagging_components[component.name] = status
-            self._json_objects['components'][component.path]['lagging'] = status
+        self.set_lags({component if isinstance(component, str) else component.name: status})
+
+    def set_lags(self, lags):
+        """
+        Sets the lag status of multiple components at once (See set_lag() for
+        more details)
+
+        Args:
+            lags: a dictionary mapping the names of components to a boolean for
+                if they should or should not be lagged
+        """
+        lagging_components = self.lagging_components
+        components = self.components
+        comps_json = self._json_objects['components']
+        for name, status in lags.items():
+            lagging_components[name] = status
+            comps_json[components[name].path]['lagging'] = status
+        self._wiring_cache.clear()
 
     def get_lava_components(self, *component_names, unwrap=True):
         """
@@ -175,23 +245,71 @@ class LavaContext(Context):
         """
         if len(component_names) == 0:
             return None
+        if len(component_names) == 1 and unwrap:
+            p = self.mapped_processes.get(component_names[0])
+            if p is None:
+                warn(_MISSING_LAVA_COMPONENT.format(component_names[0]))
+            return p
+
         _components = []
         for a in component_names:
-            if a in self.mapped_processes.keys():
-                _components.append(self.mapped_processes[a])
+            p = self.mapped_processes.get(a)
+            if p is not None:
+                _components.append(p)
             else:
-                warn(f"Could not fine a lava component with the name \"{a}\" in the context")
-        return _components if len(component_names) > 1 or not unwrap else _components[0]
+                warn(_MISSING_LAVA_COMPONENT.format(a))
+        return _components
 
     def write_to_ngc(self):
         """
-        Copies all the current values of the lava model into the ngc model
+        Copies all the current values of the lava model into the ngc model.
+        All the values of a process are pulled from the runtime before any of
+        them are written back to the ngc components.
         """
-        for p_name, lc in self.mapped_processes.items():
-            for a_name, a in lc.__dict__.items():
-                if isinstance(a, Var):
-                    if Compartment.is_compartment(self.components[p_name].__dict__[a_name]):
-                        self.components[p_name].__dict__[a_name].set(a.get())
+        for pairs in self._var_sync_plan.values():
+            values = [var.get() for var, _ in pairs]
+            for (_, comp), value in zip(pairs, values):
+                comp.set(value)
+
+    def refresh_params(self):
+        """
+        Copies the current compartment values and array parameters of the ngc
+        model into the existing lava model without rebuilding any of the lava
+        components. This is the default path taken by a rebuild when the topology
+        of the model has not changed.
+
+        Scalar parameters are fixed when the lava processes are built, a warning
+        is logged for any that have changed since, use rebuild_lava() to apply them.
+        """
+        for pairs in self._var_sync_plan.values():
+            for var, comp in pairs:
+                self._push_to_var(var, comp.value)
+
+        components = self.components
+        mp = self.mapped_processes
+        for k, pairs in self._param_sync_plan.items():
+            source = components[k].__dict__
+            process = mp[k]
+            for var, a_name in pairs:
+                self._push_to_var(var, process.cast_param(a_name, source[a_name]))
+            process.freeze_reset_params()
+
+        for k, process in mp.items():
+            if k not in components:
+                continue
+            source = components[k].__dict__
+            for p, value in process.built_scalars.items():
+                if self._scalar_key(source.get(p)) != self._scalar_key(value):
+                    warn(f"Scalar parameter {p} of {k} has changed since its lava process was built, "
+                         f"call rebuild_lava() to apply it")
+
+    @staticmethod
+    def _push_to_var(var, value):
+        # Var.set() needs a runtime, before one exists the initial value is replaced
+        if var.process is not None and var.process.runtime is not None:
+            var.set(value)
+        else:
+            var.init = value
 
 
     def make_components(self, path_to_components_file, custom_file_dir=None):
@@ -199,39 +317,116 @@ class LavaContext(Context):
         with open(path_to_components_file, 'r') as file:
             componentsConfig = json.load(file)
             components = componentsConfig["components"]
-            _previous_model_name = "/".join(list(components.keys())[0].split("/")[:-1]) + "/"
-            for comp in comps:
-                if components[_previous_model_name + comp.name].get('lagging', False):
-                    self.set_lag(comp, True)
-
-
+            by_suffix = {k.rsplit("/", 1)[-1]: v for k, v in components.items()}
+            self.set_lags({comp.name: True for comp in comps
+                           if by_suffix.get(comp.name, {}).get('lagging', False)})
+
+
+
+    def _compute_topology_hash(self):
+        # Scalar parameters are fixed when a lava process is built, the vars and ports are
+        # sized by the mapped values, and parameters that no longer fit their precision
+        # need a wider var, so a change to any of them needs a rebuild
+        dlp = self.dynamic_lava_processes
+        lagging_components = self.lagging_components
+        return hash(tuple((k, id(v), v.__class__, lagging_components.get(k, False),
+                           tuple((conn.destination.name, tuple(source.name for source in conn.sources))
+                                 for conn in v.connections),
+                           tuple(self._scalar_key(v.__dict__.get(p))
+                                 for p in (dlp[k].scalar_params if k in dlp else ())),
+                           tuple((name, _value_schema(self._mapped_value(v, name)))
+                                 for name in (dlp[k]._var_layouts if k in dlp else ())),
+                           tuple(_fits_precision(v.__dict__[p], dlp[k]._param_dtype)
+                                 for p in (dlp[k]._cast_params if k in dlp else ())))
+                          for k, v in self.components.items()))
+
+    @staticmethod
+    def _scalar_key(value):
+        # A scalar parameter replaced by an array is unhashable, its schema alone forces the rebuild
+        return _value_schema(value), (value if isinstance(value, _SCALAR_TYPES) else None)
+
+    @staticmethod
+    def _mapped_value(component, name):
+        value = component.__dict__.get(name)
+        return value.value if isinstance(value, Compartment) else value
 
     def _update_dynamic_class(self):
         info("updating dynamic classes")
-        for k, v in self.components.items():
-            process, model = map_component(v, lag=self.lagging_components.get(k, False))
-            self.dynamic_lava_processes[k] = process
-            self.dynamic_lava_models[k] = model
+        components = self.components
+        lagging_components = self.lagging_components
+        jit = self._jit
+        precision = self._precision
+        dlp = self.dynamic_lava_processes
+        dlm = self.dynamic_lava_models
+        # Mapped serially so identical components share one cached class pair and models are named in order
+        for k, v in components.items():
+            dlp[k], dlm[k] = map_component(v, lag=lagging_components.get(k, False), jit=jit, precision=precision)
 
     def _build_lava_processes(self):
         info("building lava processes")
+        from lava.magma.core.process.variable import Var
+
+        # Processes are built serially as lava hands out process and var ids from a shared counter
+        components = tuple(self.components.items())
+        dlp = self.dynamic_lava_processes
+        built = {k: dlp[k](v, name=k) for k, v in components}
+        self.mapped_processes.update(built)
+
+        plan = self._var_sync_plan
+        param_plan = self._param_sync_plan
+        plan.clear()
+        param_plan.clear()
+        for k, v in components:
+            lc = built[k]
+            plan[k] = []
+            param_plan[k] = []
+            for a_name, a in lc.__dict__.items():
+                if not isinstance(a, Var):
+                    continue
+                if Compartment.is_compartment(v.__dict__[a_name]):
+                    plan[k].append((a, v.__dict__[a_name]))
+                else:
+                    param_plan[k].append((a, a_name))
+
+    def _build_wiring_cache(self):
+        info("building wiring cache")
+        mp = self.mapped_processes
+        cache = self._wiring_cache
+        inp_names = self._inp_names
+        out_names = self._out_names
+        cache.clear()
         for k, v in self.components.items():
-            self.mapped_processes[k] = self.dynamic_lava_processes[k](v, name=k)
-
-    def _wire_lava_processes(self):
-        info("wiring lava processes")
-        for k, v in self.components.items():
+            # Group sources by destination port so each port is connected once
+            wires = {}
             for conn in v.connections:
-
-                dest_component, dest_compartment = conn.destination.name.split("/")
-                if dest_compartment not in self.mapped_processes[dest_component].__dict__.keys():
+                dest_component, dest_compartment = _split_endpoint(conn.destination.name)
+                if dest_compartment not in mp[dest_component].__dict__.keys():
                     continue
 
-                dest = self.mapped_processes[dest_component].__dict__["_inp_" + dest_compartment]
+                dest_attr = inp_names.get(dest_compartment)
+                if dest_attr is None:
+                    dest_attr = inp_names[dest_compartment] = sys.intern("_inp_" + dest_compartment)
+
+                sources = wires.setdefault((dest_component, dest_attr), [])
                 for source in conn.sources:
-                    source_component, source_compartment = source.name.split("/")
-                    sor = self.mapped_processes[source_component].__dict__["_out_" + source_compartment]
-                    dest.connect_from(sor)
+                    source_component, source_compartment = _split_endpoint(source.name)
+                    source_attr = out_names.get(source_compartment)
+                    if source_attr is None:
+                        source_attr = out_names[source_compartment] = sys.intern("_out_" + source_compartment)
+                    sources.append((attrgetter(source_attr), source_component))
+            cache[k] = [(dest_component, attrgetter(dest_attr), sources)
+                        for (dest_component, dest_attr), sources in wires.items()]
+
+    def _wire_lava_processes(self):
+        info("wiring lava processes")
+        if len(self._wiring_cache) == 0:
+            self._build_wiring_cache()
+
+        mp = self.mapped_processes
+        for wires in self._wiring_cache.values():
+            for dest_component, dest_get, sources in wires:
+                dest_get(mp[dest_component]).connect_from(
+                    [source_get(mp[source_component]) for source_get, source_component in sources])
 
     def save_to_json(self, directory, model_name=None, custom_save=True, overwrite=False, skip_lava=False):
         """
@@ -295,6 +490,8 @@ class LavaContext(Context):
 
             rest_image: The image to be clamped while the model is in its reset state (default: None)
         """
+        from lava.magma.core.run_conditions import RunSteps
+        from lava.magma.core.run_configs import Loihi2SimCfg
 
         if not hasattr(self, "clamp"):
             warn(f"Clamp method is missing from {self.name}, "
@@ -304,6 +501,16 @@ class LavaContext(Context):
         else:
             cc = core_component
 
+        run_cfg = Loihi2SimCfg()
+        run_conditions = {}
+
+        def run_steps(t):
+            condition = run_conditions.get(t)
+            if condition is None:
+                condition = run_conditions[t] = RunSteps(num_steps=t)
+            cc.run(condition=condition, run_cfg=run_cfg)
+            cc.pause()
+
         with self:
             @self.dynamicCommand
             def pause():
@@ -320,20 +527,22 @@ class LavaContext(Context):
 
             @self.dynamicCommand
             def run(t):
-                self._can_run("run")
-                cc.run(condition=RunSteps(num_steps=t), run_cfg=Loihi2SimCfg())
-                self.pause()
+                if not self._in_runtime:
+                    self._can_run("run")
+                run_steps(t)
 
             if rest_image is not None:
                 @self.dynamicCommand
                 def rest(t):
-                    self._can_run("rest")
+                    if not self._in_runtime:
+                        self._can_run("rest")
                     self.clamp(rest_image)
                     self.run(t)
 
             @self.dynamicCommand
             def view(x, t):
-                self._can_run("view")
+                if not self._in_runtime:
+                    self._can_run("view")
                 self.clamp(x)
                 self.run(t)
 
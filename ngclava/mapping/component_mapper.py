@@ -2,8 +2,12 @@
 Contains the method for mapping a ngclearn component to a lava component.
 This is mostly used as a helper method and should not be called by itself.
 
-This method does muddle the globals dictionary with uuids as they are needed
-for lava to bind processes to models.
+This method does muddle the globals dictionary with the generated models as
+they are needed for lava to bind processes to models. Each generated model is
+registered once under a stable name.
+
+Mapped classes are cached, components of the same class with the same
+compartment shapes, inputs, and flags share a single process and model class.
 """
 from lava.magma.core.process.process import AbstractProcess
 from lava.magma.core.process.variable import Var
@@ -15,120 +19,375 @@ from lava.magma.core.model.py.model import PyLoihiProcessModel
 from ngcsimlib.compilers.component_compiler import parse
 from lava.magma.core.model.py.ports import PyInPort, PyOutPort
 from lava.magma.core.process.ports.ports import InPort, OutPort
-from ngclearn import numpy as np
+from ngclearn import numpy as np, Compartment
+from ngcsimlib.logger import warn
 
-import uuid
+import inspect
+import itertools
 
-def map_component(source_obj, lag=False):
-    """
-    Dynamically makes a lava process and a lava model class based off the source
-    object provided.
+try:
+    from numba import njit
+    from numba.core.errors import NumbaError
+except ImportError:
+    njit = None
 
-    Args:
-        source_obj: The source object to model after
+# Arrays at least this large get numba's parallel backend when jit is enabled
+_PARALLEL_JIT_SIZE = 100000
 
-        lag: is this is a lagging component (See lava context.set_lag() for more
-        details)
+_POSITIONAL = (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)
 
-    Returns: dynamic_process, dynamic_model
+# Bound once so the step loop does not resolve them through the numpy module
+_ndarray = np.ndarray
+_reshape = np.reshape
+# Values that carry a shape, numpy scalars report an empty shape
+_SHAPED_TYPES = (_ndarray, np.generic)
 
-    """
-    (pure_fn, output_compartments, args, parameters, compartments) = parse(source_obj, "advance_state")
-    args = []
-    assert len(args) == 0
-    all_vals = {**{p: source_obj.__dict__[p] for p in parameters},
-                **{c: source_obj.__dict__[c].value for c in compartments},
-                **{oc: source_obj.__dict__[oc].value for oc in output_compartments}}
+_SCALAR_TYPES = (int, float, np.number, np.bool_)
 
-    try:
-        (pure_reset, output_compartments_reset, args_reset, parameters_reset, compartments_reset) = parse(source_obj, "reset")
-    except:
-        (pure_reset, output_compartments_reset, args_reset, parameters_reset, compartments_reset) = None, None, None, None, None
+# Storage types for non-learned parameters, bf16 is not available in base numpy
+_PRECISIONS = {None: None, "fp32": np.float32, "fp16": np.float16}
 
+_mapped_components = {}
+_model_ids = itertools.count()
 
+def _value_schema(value):
+    """
+    The class, shape, and dtype of a mapped value, two values with the same
+    schema can share a lava var layout.
+    """
+    if isinstance(value, _SHAPED_TYPES):
+        return value.__class__, value.shape, value.dtype
+    return value.__class__, None, None
 
-    class dynamic_lava_process(AbstractProcess):
-        def __init__(self, source_object, **kwargs):
-            super().__init__(**kwargs)
-
-            for k, v in all_vals.items():
-                val = source_object.__dict__.get(k, kwargs.get(k, 0))
-                val = val.value if hasattr(val, "value") else val
-                self.__dict__[k] = Var(v.shape if hasattr(v, 'shape') else (1,), val, name=k)
-
-            for conn in source_obj.connections:
-                c_name = conn.destination.name.split("/")[-1]
-                if c_name in all_vals.keys():
-                    self.__dict__["_inp_" + c_name] = InPort(shape=self.__dict__[c_name].shape)
-
-            for oc in output_compartments:
-                self.__dict__["_out_" + oc] = OutPort(shape=self.__dict__[oc].shape)
+def _fits_precision(value, dtype):
+    """
+    Checks if value can be stored as dtype without overflowing to inf or
+    underflowing to zero.
+    """
+    original = np.asarray(value)
+    cast = original.astype(dtype)
+    return bool(np.all(np.isfinite(cast) == np.isfinite(original)) and np.all((cast == 0) == (original == 0)))
 
-        def reset(self):
-            if pure_reset is None:
-                return
+def _parse_component(source_obj):
+    """
+    Parses the advance_state and reset methods of the source object. This is
+    done for every object as the split into parameters and compartments
+    depends on the object itself (e.g. compartments watched by a monitor).
+    """
+    advance = parse(source_obj, "advance_state")
+    try:
+        reset = parse(source_obj, "reset")
+    except:
+        reset = None, None, None, None, None
+    return advance, reset
 
-            funParams = {narg: source_obj.__dict__[narg] for narg in list(parameters_reset)}
-            funComps = {narg: self.__dict__[narg] for narg in list(compartments_reset)}
+def _arg_plan(fn, parameters, compartments):
+    """
+    Orders the parameters and compartments of fn by its signature so that it
+    can be called positionally. Each entry of the plan is the name of the
+    argument and if it is a parameter. Returns None if the signature does not
+    match the parsed parameters and compartments.
+    """
+    names = {*parameters, *compartments}
+    signature = inspect.signature(fn).parameters.values()
+    if len(signature) != len(names) or any(arg.name not in names or arg.kind not in _POSITIONAL
+                                           for arg in signature):
+        return None
+    return tuple((arg.name, arg.name in parameters) for arg in signature)
+
+def _call_source(fn, parameters, compartments, params_src="d"):
+    """
+    Builds the source of a call to `_fn` with all of its parameters and
+    compartments read from the mapping `d`, or parameters from params_src if
+    given. The arguments are passed positionally when the signature of fn
+    allows it, and otherwise as an unpacked dictionary since compartment names
+    are not always valid identifiers (e.g. those made by monitors).
+    """
+    plan = _arg_plan(getattr(fn, "py_func", fn), parameters, compartments)
+    if plan is not None:
+        call_args = [f"{params_src if is_param else 'd'}[{n!r}]" for n, is_param in plan]
+        return f"_fn({', '.join(call_args)})"
+    kw_args = [f"{p!r}: {params_src}[{p!r}]" for p in parameters] + [f"{c!r}: d[{c!r}]" for c in compartments]
+    return f"_fn(**{{{', '.join(kw_args)}}})"
+
+def _assign_source(outputs):
+    """
+    Builds the source that stores the result of a call into `d`, specialized
+    for the number of outputs.
+    """
+    if len(outputs) == 0:
+        return ""
+    if len(outputs) == 1:
+        return f"d[{outputs[0]!r}] = "
+    return ", ".join(f"d[{oc!r}]" for oc in outputs) + " = "
+
+def _compile_function(name, lines, namespace):
+    src = "\n".join(lines) + "\n"
+    scope = {}
+    exec(compile(src, f"<{name}>", "exec"), {"__name__": __name__, **namespace}, scope)
+    return scope[name]
+
+def _make_trampoline(name, fn, parameters, compartments, params_arg=None):
+    """
+    Generates a function that calls fn with all of its parameters and
+    compartments. Values are read from the instance dictionary of the object
+    the function is called with, if params_arg is given the parameters are
+    instead read from the mapping passed as that argument.
+    """
+    params_src = "d" if params_arg is None else params_arg
+    signature = "self" if params_arg is None else f"self, {params_arg}"
+    return _compile_function(name, [f"def {name}({signature}):",
+                                    f"    d = self.__dict__",
+                                    f"    return {_call_source(fn, parameters, compartments, params_src)}"],
+                             {"_fn": fn})
+
+def _make_run_spk(fn, parameters, compartments, output_compartments, inp_bindings, out_bindings, lag):
+    """
+    Generates the run_spk method of a lava model. The gather, dynamics, and
+    send steps are unrolled for the known ports of the component with the port
+    names and output shapes baked in as constants.
+    """
+    send = []
+    for oc, out_name, shape in out_bindings:
+        # Outputs normally come back in the right shape, skip the reshape then
+        send += [f"    value = d[{oc!r}]",
+                 "    if isinstance(value, _ndarray):",
+                 f"        if value.shape != {shape!r}:",
+                 f"            value = value.reshape({shape!r})",
+                 "    else:",
+                 f"        value = _reshape(value, {shape!r})",
+                 f"    d[{out_name!r}].send(value)"]
+
+    lines = ["def run_spk(self):",
+             "    d = self.__dict__"]
+    if lag:
+        lines += send
+    lines += [f"    d[{comp!r}] = d[{inp_name!r}].recv()" for comp, inp_name in inp_bindings]
+    lines.append(f"    {_assign_source(output_compartments)}{_call_source(fn, parameters, compartments)}")
+    if not lag:
+        lines += send
+    return _compile_function("run_spk", lines, {"_fn": fn, "_ndarray": _ndarray, "_reshape": _reshape})
+
+def _jit_compile(fn, parameters, compartments, sample_vals):
+    """
+    Compiles fn with numba and calls it once with the sample values so the
+    compilation cost is paid when the component is mapped instead of on the
+    first step of the runtime. Returns fn unchanged if numba can not compile it,
+    e.g. for float16 parameters which numba does not support.
+    """
+    parallel = any(np.size(v) >= _PARALLEL_JIT_SIZE for v in sample_vals.values())
+    jitted = njit(cache=True, fastmath=True, parallel=parallel)(fn)
+    try:
+        jitted(**{narg: sample_vals[narg] for narg in (*parameters, *compartments)})
+    except NumbaError as e:
+        warn(f"Unable to jit {fn.__qualname__}, falling back to python: {e}")
+        return fn
+    return jitted
 
-            vals = pure_reset.__func__(**funParams, **funComps)
-            for key, v in zip(output_compartments_reset, vals):
-                # self.__dict__[key] = Var(v.shape if hasattr(v, 'shape') else (1,), v, name=key)
-                self.__dict__[key].set(v)
+class _DynamicLavaProcessBase(AbstractProcess):
+    """
+    The shared base of all mapped processes, map_component subclasses it and
+    attaches the tables describing the vars and ports of the source component.
+    """
+    scalar_params = ()
+    _var_layouts = {}
+    _cast_params = ()
+    _param_dtype = None
+    _conn_bindings = {}
+    _output_compartments = ()
+    _reset_fn = None
+    _parameters_reset = ()
+    _output_compartments_reset = ()
+
+    def __init__(self, source_object, **kwargs):
+        # The values the scalar parameters were built with, they can not change without a rebuild
+        self.built_scalars = {p: source_object.__dict__[p] for p in self.scalar_params}
+        super().__init__(**kwargs, **self.built_scalars)
+        self._source_object = source_object
+
+        for k, (_, shape) in self._var_layouts.items():
+            val = source_object.__dict__.get(k, kwargs.get(k, 0))
+            val = self.cast_param(k, val.value if isinstance(val, Compartment) else val)
+            self.__dict__[k] = Var(shape, val, name=k)
+
+        for c_name, inp_name in self._conn_bindings.items():
+            self.__dict__[inp_name] = InPort(shape=self.__dict__[c_name].shape)
+
+        for oc in self._output_compartments:
+            self.__dict__["_out_" + oc] = OutPort(shape=self.__dict__[oc].shape)
+
+        self.freeze_reset_params()
+
+    def cast_param(self, name, value):
+        """
+        Casts the value of a parameter to the precision it is stored at in this
+        process, other values are returned unchanged
+        """
+        if name not in self._cast_params:
+            return value
+        return np.asarray(value, dtype=self._param_dtype)
+
+    def freeze_reset_params(self):
+        """
+        Snapshots the parameters used by reset from the source object, called
+        on construction and whenever the lava context refreshes its parameters
+        """
+        if self._reset_fn is not None:
+            source = self._source_object.__dict__
+            self._reset_params = {narg: source[narg] for narg in self._parameters_reset}
+
+    def reset(self):
+        if self._reset_fn is None:
+            return
+
+        vals = self._reset_fn(self._reset_params)
+        for key, v in zip(self._output_compartments_reset, vals):
+            self.__dict__[key].set(v)
+
+
+@implements(protocol=LoihiProtocol)
+@requires(CPU)
+@tag('floating_pt')
+class _DynamicLavaModelBase(PyLoihiProcessModel):
+    """
+    The shared base of all mapped models, map_component subclasses it with the
+    generated run_spk and the lava types of the ports and vars, and binds the
+    subclass to its process.
+    """
+    scalar_params = ()
 
-    @implements(proc=dynamic_lava_process, protocol=LoihiProtocol)
-    @requires(CPU)
-    @tag('floating_pt')
-    class dynamic_lava_model(PyLoihiProcessModel):
-        def run_spk(self):
-            if lag:
-                #T-1 Outputs
-                for oc in output_compartments:
-                    self.__dict__["_out_" + oc].send(np.reshape(self.__dict__[oc], source_obj.__dict__[oc].value.shape))
+    def __init__(self, proc_params=None):
+        super().__init__(proc_params)
+        for p in self.scalar_params:
+            self.__dict__[p] = proc_params[p]
 
-            #Gather
-            for comp in compartments:
-                if hasattr(self, "_inp_" + comp):
-                    self.__dict__[comp] = self.__dict__["_inp_" + comp].recv()
 
-            #Run Dynamics
-            _param_loc = 0
-            _comps_loc = 0
+def map_component(source_obj, lag=False, jit=False, precision=None):
+    """
+    Dynamically makes a lava process and a lava model class based off the source
+    object provided.
 
-            funParams = {narg: self.__dict__[narg] for narg in list(parameters)}
-            funComps = {narg: self.__dict__[narg] for narg in list(compartments)}
+    Args:
+        source_obj: The source object to model after
 
-            vals = pure_fn.__func__(**funParams, **funComps)
-            if len(output_compartments) == 1:
-                vals = [vals]
+        lag: is this is a lagging component (See lava context.set_lag() for more
+        details)
 
-            for key, v in zip(output_compartments, vals):
-                self.__dict__[key] = v
+        jit: should the dynamics of the component be compiled with numba, ignored
+        if numba is not installed (default: False). Lava components are built with
+        base numpy so the dynamics can not be traced by jax.jit
 
-            if not lag:
-                #Output
-                for oc in output_compartments:
-                    self.__dict__["_out_" + oc].send(np.reshape(self.__dict__[oc], source_obj.__dict__[oc].value.shape))
+        precision: the floating point precision to store parameters in, one of
+        None (leave as is), "fp32", or "fp16". Compartments are always kept at their
+        original precision to avoid accumulating error across timesteps, and
+        parameters that would overflow or underflow are kept at theirs. Only array
+        parameters are cast, scalar parameters are passed as process parameters
+        rather than Vars so casting them would save no Var bandwidth (default: None)
 
+    Returns: dynamic_process, dynamic_model
 
+    """
+    if precision not in _PRECISIONS:
+        raise ValueError(f"Unsupported precision \"{precision}\", expected one of {list(_PRECISIONS.keys())}")
+    param_dtype = _PRECISIONS[precision]
+
+    ((pure_fn, output_compartments, args, parameters, compartments),
+     (pure_reset, output_compartments_reset, args_reset, parameters_reset, compartments_reset)) = \
+        _parse_component(source_obj)
+    if len(args) > 0:
+        raise RuntimeError(f"Unable to map {source_obj.name} to lava, advance_state can only take parameters and "
+                           f"compartments but it also takes the arguments {list(args)}")
+    all_vals = {**{p: source_obj.__dict__[p] for p in parameters},
+                **{c: source_obj.__dict__[c].value for c in compartments},
+                **{oc: source_obj.__dict__[oc].value for oc in output_compartments}}
 
-    #Make Inputs
+    conn_bindings = {}
     for conn in source_obj.connections:
-        c_name = conn.destination.name.split("/")[-1]
-        if c_name in all_vals.keys():
-            inp_name = "_inp_" + conn.destination.name.split("/")[-1]
-            setattr(dynamic_lava_model, inp_name, LavaPyType(PyInPort.VEC_DENSE, float))
+        c_name = conn.destination.name.rsplit("/", 1)[-1]
+        if c_name in all_vals.keys() and c_name not in conn_bindings:
+            conn_bindings[c_name] = "_inp_" + c_name
+
+    if param_dtype is None:
+        cast_params = ()
+    else:
+        # Only array parameters are stored in Vars, scalars are left at full precision
+        float_params = tuple(p for p in parameters
+                             if p not in conn_bindings and p not in compartments and p not in output_compartments
+                             and isinstance(all_vals[p], _ndarray) and all_vals[p].dtype.kind == "f")
+        cast_params = tuple(p for p in float_params if _fits_precision(all_vals[p], param_dtype))
+        for p in float_params:
+            if p not in cast_params:
+                warn(f"Parameter {p} of {source_obj.name} does not fit in {precision}, keeping its original "
+                     f"precision")
+
+    # The resolved functions are part of the key as resolvers can be re-registered (e.g. by monitors)
+    key = (source_obj.__class__, pure_fn.__func__, pure_reset.__func__ if pure_reset is not None else None,
+           lag, jit, precision, tuple(conn_bindings.keys()), cast_params,
+           tuple((k, _value_schema(v)) for k, v in all_vals.items()))
+    if key in _mapped_components:
+        return _mapped_components[key]
+
+    # Scalar parameters are handed to the model through the process parameters instead of as Vars
+    scalar_params = tuple(p for p in parameters
+                          if p not in conn_bindings and p not in compartments and p not in output_compartments
+                          and isinstance(all_vals[p], _SCALAR_TYPES))
+    var_vals = {k: v for k, v in all_vals.items() if k not in scalar_params}
+    # Only the class and shape of each Var are kept on the cached classes, not the values themselves
+    var_layouts = {k: (v.__class__, v.shape if isinstance(v, _SHAPED_TYPES) else (1,)) for k, v in var_vals.items()}
+
+    out_shapes = {oc: tuple(source_obj.__dict__[oc].value.shape) for oc in output_compartments}
+    # Only compartments with an incoming connection get an input port
+    inp_bindings = tuple((comp, conn_bindings[comp]) for comp in compartments if comp in conn_bindings)
+    out_bindings = tuple((oc, "_out_" + oc, out_shapes[oc]) for oc in output_compartments)
+
+    advance_fn = pure_fn.__func__
+    if jit and njit is not None:
+        # Warmed up with the values as the model will see them so the first step does not recompile
+        sample_vals = {**{p: all_vals[p] for p in scalar_params},
+                       **{k: np.asarray(v, dtype=param_dtype if k in cast_params else float).reshape(
+                           var_layouts[k][1]) for k, v in var_vals.items()}}
+        advance_fn = _jit_compile(advance_fn, parameters, compartments, sample_vals)
+    step_fn = _make_run_spk(advance_fn, parameters, compartments, output_compartments, inp_bindings,
+                            out_bindings, lag)
+
+    if pure_reset is not None:
+        reset_vals = _make_trampoline("_reset", pure_reset.__func__, parameters_reset, compartments_reset,
+                                      params_arg="params")
+
+    # Only the instance specific tables are attached, the behaviour lives on the base classes
+    proc_ns = {"__module__": __name__,
+               "scalar_params": scalar_params,
+               "_var_layouts": var_layouts,
+               "_cast_params": cast_params,
+               "_param_dtype": param_dtype,
+               "_conn_bindings": conn_bindings,
+               "_output_compartments": tuple(output_compartments)}
+    if pure_reset is not None:
+        proc_ns["_reset_fn"] = reset_vals
+        proc_ns["_parameters_reset"] = tuple(parameters_reset)
+        proc_ns["_output_compartments_reset"] = tuple(output_compartments_reset)
+    dynamic_lava_process = type("dynamic_lava_process", (_DynamicLavaProcessBase,), proc_ns)
+
+    model_ns = {"__module__": __name__,
+                "scalar_params": scalar_params,
+                "run_spk": step_fn}
+    #Make Inputs
+    for inp_name in conn_bindings.values():
+        model_ns[inp_name] = LavaPyType(PyInPort.VEC_DENSE, float)
 
     #Make Outputs
     for oc in output_compartments:
-        oc_name = "_out_" + oc
-        setattr(dynamic_lava_model, oc_name, LavaPyType(PyOutPort.VEC_DENSE, float, precision=1))
+        model_ns["_out_" + oc] = LavaPyType(PyOutPort.VEC_DENSE, float, precision=1)
+
+    for k, (cls, _) in var_layouts.items():
+        model_ns[k] = LavaPyType(cls, param_dtype if k in cast_params else float)
 
-    for k, v in all_vals.items():
-        setattr(dynamic_lava_model, k, LavaPyType(v.__class__, float))
+    dynamic_lava_model = implements(proc=dynamic_lava_process)(
+        type("dynamic_lava_model", (_DynamicLavaModelBase,), model_ns))
 
-    globals()[str(uuid.uuid4())] = dynamic_lava_model
+    globals()[f"_LavaModel_{next(_model_ids)}"] = dynamic_lava_model
 
+    _mapped_components[key] = dynamic_lava_process, dynamic_lava_model
     return dynamic_lava_process, dynamic_lava_model
 
 